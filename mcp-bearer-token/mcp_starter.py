@@ -8,6 +8,8 @@ Puch AI MCP Multi-Agent Server
 
 import asyncio
 import os
+import re
+import time
 from typing import Annotated
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field, AnyUrl
@@ -18,10 +20,16 @@ from mcp import ErrorData, McpError
 from mcp.types import INVALID_PARAMS, INTERNAL_ERROR
 
 # utils
+import ahocorasick
+import aiosqlite
 import httpx
+import orjson
+from async_lru import alru_cache
 import markdownify
-import readabilipy
-from bs4 import BeautifulSoup
+from readability import Document
+from lxml import etree
+from lxml import html as lxml_html
+from urllib.parse import quote_plus
 
 # load env
 load_dotenv()
@@ -31,62 +39,125 @@ MY_NUMBER = os.environ.get("MY_NUMBER")
 assert AUTH_TOKEN is not None, "Please set AUTH_TOKEN in .env"
 assert MY_NUMBER is not None, "Please set MY_NUMBER in .env"
 
+# Compiled once — avoids re-parsing the XPath expression per search.
+_DDG_XPATH = etree.XPath('//a[contains(@class,"result__a")]/@href')
+
 # --- Utility: fetch + simplify + search ---
 class Fetch:
     USER_AGENT = "Puch/1.0 (MultiAgentMCP)"
-    
+    MAX_BODY_BYTES = 2 * 1024 * 1024  # stop reading bodies beyond 2 MiB
+
     @classmethod
     async def fetch_url(cls, url: str, user_agent: str = None, force_raw: bool = False) -> tuple[str, str]:
         ua = user_agent or cls.USER_AGENT
-        async with httpx.AsyncClient(timeout=30) as client:
-            try:
-                resp = await client.get(url, headers={"User-Agent": ua}, follow_redirects=True)
-            except httpx.HTTPError as e:
-                raise McpError(ErrorData(code=INTERNAL_ERROR, message=f"Failed to fetch {url}: {e!r}"))
-            if resp.status_code >= 400:
-                raise McpError(ErrorData(code=INTERNAL_ERROR, message=f"Failed to fetch {url} - status {resp.status_code}"))
-            content_type = resp.headers.get("content-type", "")
-            text = resp.text
-        
+        buf = bytearray()
+        try:
+            async with HTTP_CLIENT.stream("GET", url, headers={"User-Agent": ua}) as resp:
+                if resp.status_code >= 400:
+                    raise McpError(ErrorData(code=INTERNAL_ERROR, message=f"Failed to fetch {url} - status {resp.status_code}"))
+                content_type = resp.headers.get("content-type", "")
+                async for chunk in resp.aiter_bytes():
+                    buf += chunk
+                    if len(buf) >= cls.MAX_BODY_BYTES:
+                        break
+        except httpx.HTTPError as e:
+            raise McpError(ErrorData(code=INTERNAL_ERROR, message=f"Failed to fetch {url}: {e!r}"))
+
         is_html = "text/html" in content_type
         if is_html and not force_raw:
-            simplified = cls.extract_content_from_html(text)
+            # Readability + markdownify are blocking CPU/subprocess work;
+            # run them off the event loop so concurrent tool calls keep flowing.
+            # lxml takes the raw bytes directly, so no decode pass is needed.
+            simplified = await asyncio.to_thread(cls.extract_content_from_html, bytes(buf))
             return simplified, ""
+        text = bytes(buf).decode(resp.charset_encoding or "utf-8", errors="replace")
         return text, f"Raw content with content-type: {content_type}\n"
 
     @staticmethod
-    def extract_content_from_html(html: str) -> str:
+    def extract_content_from_html(html: str | bytes) -> str:
         try:
-            ret = readabilipy.simple_json.simple_json_from_html_string(html, use_readability=True)
-            if not ret or not ret.get("content"):
+            content_html = Document(html).summary()
+            if not content_html:
                 return "<e>Failed to simplify page</e>"
-            content = markdownify.markdownify(ret["content"], heading_style=markdownify.ATX)
+            content = markdownify.markdownify(content_html, heading_style=markdownify.ATX)
             return content
         except Exception:
             return "<e>Failed to simplify page</e>"
 
     @staticmethod
     async def duckduckgo_search_links(query: str, max_results: int = 6) -> list[str]:
-        ddg = f"https://html.duckduckgo.com/html/?q={query.replace(' ', '+')}"
-        links = []
-        async with httpx.AsyncClient(timeout=20) as client:
+        ddg = f"https://html.duckduckgo.com/html/?q={quote_plus(query)}"
+        # Transient failures raise instead of returning a sentinel so the
+        # TTL cache never stores them (alru_cache does not cache exceptions).
+        try:
+            resp = await HTTP_CLIENT.get(ddg)
+        except httpx.HTTPError as e:
+            raise McpError(ErrorData(code=INTERNAL_ERROR, message=f"Search failed: {e!r}"))
+        if resp.status_code != 200:
+            raise McpError(ErrorData(code=INTERNAL_ERROR, message=f"Search failed - status {resp.status_code}"))
+        # DuckDuckGo serves UTF-8, so hand lxml the raw bytes — this skips
+        # httpx's charset detection pass and the intermediate str entirely.
+        # lxml raises ParserError for empty/unparseable bodies, not ValueError.
+        try:
+            doc = lxml_html.fromstring(resp.content)
+        except (ValueError, etree.LxmlError):
             try:
-                resp = await client.get(ddg, headers={"User-Agent": Fetch.USER_AGENT})
-            except httpx.HTTPError:
-                return ["<e>Search failed</e>"]
-            if resp.status_code != 200:
-                return ["<e>Search failed</e>"]
-            soup = BeautifulSoup(resp.text, "html.parser")
-            for a in soup.find_all("a", class_="result__a", href=True):
-                href = a["href"]
-                if href.startswith("http"):
-                    links.append(href)
-                if len(links) >= max_results:
-                    break
+                doc = lxml_html.fromstring(resp.text)
+            except (ValueError, etree.LxmlError):
+                return ["<e>No results found</e>"]
+        hrefs = _DDG_XPATH(doc)
+        links = [h for h in hrefs if h.startswith("http")][:max_results]
         return links or ["<e>No results found</e>"]
 
+# TTL caches — duplicate searches/summaries within 5 minutes are served
+# from memory instead of re-paying the HTTP + parse cost.
+_ddg_search_cached = alru_cache(maxsize=512, ttl=300)(Fetch.duckduckgo_search_links)
+
+_SENT_RE = re.compile(r"[^.!?]+[.!?]")
+
+@alru_cache(maxsize=256, ttl=300)
+async def _summarize_cached(url: str, sentences: int) -> str:
+    content, _ = await Fetch.fetch_url(url)
+    if content.startswith("<e>"):
+        raise McpError(ErrorData(code=INTERNAL_ERROR, message="Failed to fetch content."))
+
+    # Lazily pull sentences and stop at the requested count rather than
+    # splitting (and allocating) the entire page up front.
+    text = content.replace("\n", " ")
+    out = []
+    for m in _SENT_RE.finditer(text):
+        s = m.group().strip()
+        if s:
+            out.append(s)
+            if len(out) >= sentences:
+                break
+    if not out:
+        # No sentence punctuation at all (e.g. raw text/JSON) — return a
+        # bounded slice rather than an empty summary.
+        return text[:500].strip()
+    return " ".join(out)
+
+# Shared keep-alive client — reusing pooled connections avoids a fresh
+# TCP + TLS handshake on every tool call.
+HTTP_CLIENT = httpx.AsyncClient(
+    timeout=30,
+    follow_redirects=True,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+    http2=True,
+    headers={"User-Agent": Fetch.USER_AGENT},
+)
+
 # --- MCP Server instance ---
-mcp = FastMCP("Puch MultiAgent MCP Server")
+def _orjson_serializer(data) -> str:
+    """Serialize structured tool results with orjson instead of stdlib json."""
+    return orjson.dumps(data).decode()
+
+try:
+    mcp = FastMCP("Puch MultiAgent MCP Server", tool_serializer=_orjson_serializer)
+except TypeError:
+    # FastMCP >= 3 dropped tool_serializer; plain-string results (all of
+    # the tools below) are unaffected either way.
+    mcp = FastMCP("Puch MultiAgent MCP Server")
 
 # --- Required validate tool ---
 @mcp.tool
@@ -94,44 +165,113 @@ async def validate() -> str:
     """Return phone number in {country_code}{number} format (no plus)."""
     return MY_NUMBER
 
-# --- In-memory escalation queue ---
-ESCALATION_DB: list[dict] = []
-NEXT_ESCALATION_ID = 1
+# --- Escalation queue (SQLite, WAL mode) ---
+# Tickets live on disk instead of an ever-growing Python list: memory
+# stays flat, tickets survive restarts, and the status index serves
+# filtered listings without a full scan.
+ESCALATION_DB_PATH = os.environ.get("ESCALATION_DB_PATH", "escalations.db")
 
-def _push_escalation(item: dict) -> dict:
-    global NEXT_ESCALATION_ID
-    item["id"] = NEXT_ESCALATION_ID
-    NEXT_ESCALATION_ID += 1
-    ESCALATION_DB.append(item)
+_escalation_db: aiosqlite.Connection | None = None
+_escalation_db_lock = asyncio.Lock()
+
+async def _get_escalation_db() -> aiosqlite.Connection:
+    global _escalation_db
+    if _escalation_db is None:
+        # Serialize first-call initialization: without the lock, two
+        # concurrent tool calls could both connect and leak one connection.
+        async with _escalation_db_lock:
+            if _escalation_db is None:
+                db = await aiosqlite.connect(ESCALATION_DB_PATH, isolation_level=None)
+                db.row_factory = aiosqlite.Row
+                await db.execute("PRAGMA journal_mode=WAL")
+                await db.execute(
+                    """CREATE TABLE IF NOT EXISTS escalations (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        query TEXT NOT NULL,
+                        priority INTEGER NOT NULL,
+                        status TEXT NOT NULL DEFAULT 'open',
+                        human_response TEXT,
+                        created_ns INTEGER NOT NULL
+                    )"""
+                )
+                await db.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_status ON escalations(status)"
+                )
+                _escalation_db = db
+    return _escalation_db
+
+async def _push_escalation(item: dict) -> dict:
+    db = await _get_escalation_db()
+    # time_ns() is a plain integer read — cheaper than building a
+    # datetime per ticket; rows are formatted only when listed.
+    item["created_ns"] = time.time_ns()
+    cur = await db.execute(
+        "INSERT INTO escalations (query, priority, status, human_response, created_ns) "
+        "VALUES (?, ?, ?, ?, ?) RETURNING id",
+        (item["query"], item["priority"], item["status"], item["human_response"], item["created_ns"]),
+    )
+    row = await cur.fetchone()
+    item["id"] = row["id"]
     return item
 
 # --- Customer Care Agent ---
+FAQ = {
+    "refund": "Our refund policy: please request within 14 days at https://example.com/refund. Refunds processed in 5-7 business days.",
+    "tracking": "To track your order use the tracking link emailed to you, or visit https://example.com/track and enter order id.",
+    "cancel": "Orders can be cancelled within 2 hours of purchase from your orders page.",
+    "warranty": "All electronics have a 1-year limited warranty (see https://example.com/warranty)."
+}
+
+# Tokenize once and test set membership instead of chaining substring
+# scans over the whole query for every keyword.
+_TOK = re.compile(r"[a-z]+")
+_SEARCH_KW = frozenset({"find", "search", "web", "look"})
+_SUPPORT_KW = frozenset({"refund", "tracking", "cancel", "warranty", "support"})
+
+# Multi-pattern automaton: finds every FAQ key in one O(len(query)) pass,
+# regardless of how large the FAQ grows.
+_FAQ_AUTOMATON = ahocorasick.Automaton()
+for _k, _v in FAQ.items():
+    _FAQ_AUTOMATON.add_word(_k, (_k, _v))
+_FAQ_AUTOMATON.make_automaton()
+
 async def customer_care_agent(query: str) -> str:
-    faq = {
-        "refund": "Our refund policy: please request within 14 days at https://example.com/refund. Refunds processed in 5-7 business days.",
-        "tracking": "To track your order use the tracking link emailed to you, or visit https://example.com/track and enter order id.",
-        "cancel": "Orders can be cancelled within 2 hours of purchase from your orders page.",
-        "warranty": "All electronics have a 1-year limited warranty (see https://example.com/warranty)."
-    }
-    q_lower = query.lower()
-    for k, v in faq.items():
-        if k in q_lower:
-            return f"📞 Customer Care: {v}"
-    
-    escalated = _push_escalation({
-        "query": query, 
-        "from": "user", 
-        "priority": 3, 
-        "status": "open", 
+    for _, (k, v) in _FAQ_AUTOMATON.iter(query.lower()):
+        return f"📞 Customer Care: {v}"
+
+    escalated = await _push_escalation({
+        "query": query,
+        "priority": 3,
+        "status": "open",
         "human_response": None
     })
     return f"📞 Customer Care: I couldn't confidently answer — I've created an escalation (id={escalated['id']}) for a human operator to handle."
 
 # --- Web Search Agent ---
+# Fan out link fetches over the keep-alive pool, capped so a single
+# search can't monopolize sockets.
+_SEARCH_SEM = asyncio.Semaphore(4)
+
+async def _link_summary(link: str) -> str:
+    async with _SEARCH_SEM:
+        content, _ = await Fetch.fetch_url(link)
+        return f"- {link}\n  {content[:200]}"
+
 async def web_search_agent(query: str, engine: str = "duckduckgo") -> str:
     if engine.lower() in ("duckduckgo", "ddg"):
-        links = await Fetch.duckduckgo_search_links(query, max_results=6)
-        results = [f"- {link}" for link in links[:4]]
+        try:
+            links = await _ddg_search_cached(query, 6)
+        except McpError:
+            return f"🔎 Web Search ({engine}) results for: {query}\n\n- <e>Search failed</e>"
+        if links[0].startswith("<e>"):
+            return f"🔎 Web Search ({engine}) results for: {query}\n\n- {links[0]}"
+        summaries = await asyncio.gather(
+            *(_link_summary(link) for link in links[:4]), return_exceptions=True
+        )
+        results = [
+            s if isinstance(s, str) else f"- {link}"
+            for link, s in zip(links[:4], summaries)
+        ]
         return f"🔎 Web Search ({engine}) results for: {query}\n\n" + "\n".join(results)
     else:
         raise McpError(ErrorData(code=INVALID_PARAMS, message=f"Unsupported engine: {engine}"))
@@ -145,56 +285,64 @@ async def supervisor(
     search_engine: Annotated[str | None, Field(description="Which search engine to use (default: duckduckgo)")] = None,
 ) -> str:
     """Supervisor routes requests between customer care and web search, and decides escalation to human operator."""
-    
+
+    # Urgent tickets escalate immediately — keep this ahead of any
+    # lowercasing/tokenizing so priority-5 requests skip the string work.
     if priority >= 5:
-        ticket = _push_escalation({
-            "query": query, 
-            "from": "user", 
-            "priority": priority, 
-            "status": "open", 
+        ticket = await _push_escalation({
+            "query": query,
+            "priority": priority,
+            "status": "open",
             "human_response": None
         })
         return f"Supervisor: Urgent issue — escalated to human operator with id={ticket['id']}."
     
-    il = intent.lower() if intent else ""
-    ql = query.lower()
-    
-    if "search" in il or il == "web" or il == "search" or "find" in ql or "look for" in ql:
+    source = query if intent is None else f"{intent} {query}"
+    tokens = set(_TOK.findall(source.lower()))
+
+    if tokens & _SEARCH_KW:
         engine = search_engine or "duckduckgo"
         return await web_search_agent(query, engine=engine)
-    elif "support" in il or il == "support" or "refund" in ql or "tracking" in ql or "cancel" in ql:
+    elif tokens & _SUPPORT_KW:
         return await customer_care_agent(query)
     else:
         return await customer_care_agent(query)
 
 # --- List escalations ---
+_ESCALATION_ROW = "id={id} | priority={priority} | status={status} | created={created} | query={query}".format_map
+
 @mcp.tool
-async def list_escalations(
-    status: Annotated[str | None, Field(description="Filter by status: open|resolved")] = None
-) -> str:
-    """List current escalations (human operators only)."""
-    rows = [e for e in ESCALATION_DB if (status is None or e["status"] == status)]
+async def list_escalations(status: str | None = None) -> str:
+    """List current escalations (human operators only). Optionally filter by status: open|resolved."""
+    db = await _get_escalation_db()
+    # created_ns is formatted here, only for rows actually listed.
+    select = (
+        "SELECT id, priority, status, query, "
+        "datetime(created_ns / 1000000000, 'unixepoch') AS created "
+        "FROM escalations"
+    )
+    if status is None:
+        cur = await db.execute(select + " ORDER BY id")
+    else:
+        cur = await db.execute(select + " WHERE status = ? ORDER BY id", (status,))
+    rows = await cur.fetchall()
     if not rows:
         return "No escalations."
-    return "\n".join(
-        f"id={e['id']} | priority={e['priority']} | status={e['status']} | query={e['query']}" 
-        for e in rows
-    )
+    return "\n".join(_ESCALATION_ROW(e) for e in rows)
 
 # --- Respond to escalation ---
 @mcp.tool
-async def respond_escalation(
-    ticket_id: Annotated[int, Field(description="Escalation ticket id")], 
-    human_response: Annotated[str, Field(description="Human's reply text")]
-) -> str:
-    """Provide a human response to an escalation ticket (resolves ticket)."""
-    for e in ESCALATION_DB:
-        if e["id"] == ticket_id:
-            e["human_response"] = human_response
-            e["status"] = "resolved"
-            return f"Escalation id={ticket_id} marked resolved. Human response:\n\n{human_response}"
-    
-    raise McpError(ErrorData(code=INVALID_PARAMS, message=f"Ticket id {ticket_id} not found."))
+async def respond_escalation(ticket_id: int, human_response: str) -> str:
+    """Provide a human response to an escalation ticket id (resolves ticket)."""
+    db = await _get_escalation_db()
+    cur = await db.execute(
+        "UPDATE escalations SET human_response = ?, status = 'resolved' WHERE id = ? RETURNING id",
+        (human_response, ticket_id),
+    )
+    row = await cur.fetchone()
+    if row is None:
+        raise McpError(ErrorData(code=INVALID_PARAMS, message=f"Ticket id {ticket_id} not found."))
+    return f"Escalation id={ticket_id} marked resolved. Human response:\n\n{human_response}"
 
 # --- Summarize URL ---
 @mcp.tool
@@ -203,13 +351,7 @@ async def summarize_url(
     sentences: Annotated[int, Field(description="Approx. sentences", ge=1, le=10)] = 3
 ) -> str:
     """Summarize a web page (uses readability + simple summarization by trimming)."""
-    content, _ = await Fetch.fetch_url(str(url))
-    if content.startswith("<e>"):
-        raise McpError(ErrorData(code=INTERNAL_ERROR, message="Failed to fetch content."))
-    
-    text = content.replace("\n", " ").strip()
-    sentences_list = [s.strip() for s in text.split(". ") if s.strip()]
-    return ". ".join(sentences_list[:sentences]) + ("." if len(sentences_list) >= sentences else "")
+    return await _summarize_cached(str(url), sentences)
 
 # --- Run server ---
 # --- Run server ---
@@ -232,8 +374,20 @@ async def main():
     print(f"\n🌐 Server starting on http://{HOST}:{PORT}")
 
     # Start HTTP transport
-    await mcp.run_async("streamable-http", host=HOST, port=PORT)
+    try:
+        await mcp.run_async("streamable-http", host=HOST, port=PORT)
+    finally:
+        await HTTP_CLIENT.aclose()
+        if _escalation_db is not None:
+            await _escalation_db.close()
 
 
 if __name__ == "__main__":
+    # libuv event loop: drop-in throughput win for I/O-heavy servers
+    # (not available on Windows).
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     asyncio.run(main())